@@ -190,6 +190,13 @@ class GitBackend(Backend):
   else:
     GIT_BINARY = 'git'
 
+  # This is a mapping of
+  #   (realpath(checkout_dir), repo_url) -> git_revision
+  # recording the last revision which this process checked out in a given
+  # checkout_dir. A hit only skips probing the repo for `revision`; the checkout
+  # itself is still verified on every call.
+  _CHECKOUT_CACHE = {}
+
   def __init__(self, *args, **kwargs):
     super(GitBackend, self).__init__(*args, **kwargs)
     self._did_ensure = False
@@ -257,9 +264,9 @@ class GitBackend(Backend):
         # note that it's safe to re-init an existing git repo. This should allow
         # us to switch between GitBackend and other Backends.
         self._execute(self.GIT_BINARY, 'init', self.checkout_dir)
-        self._did_ensure = True
       except subprocess.CalledProcessError as e:
         raise GitFetchError(False, 'Git "init" failed: '+e.message)
+    self._did_ensure = True
 
   def _has_rev(self, revision):
     """Returns True iff the on-disk repo has the given revision."""
@@ -272,6 +279,15 @@ class GitBackend(Backend):
     except GitFetchError:
       return False
 
+  def _is_clean_checkout(self, revision):
+    """Returns True iff HEAD is `revision` and the checkout has no changes."""
+    try:
+      if self._git('rev-parse', 'HEAD').strip() != revision:
+        return False
+      self._git('diff', '--quiet', revision)
+      return True
+    except GitFetchError:
+      return False
 
   ### Backend implementations
 
@@ -291,6 +307,16 @@ class GitBackend(Backend):
     if not revision:
       revision = self.resolve_refspec(refspec)
 
+    cache_key = (os.path.realpath(self.checkout_dir), self.repo_url)
+    if self._CHECKOUT_CACHE.get(cache_key) == revision:
+      # Other processes (or the user) may have touched the checkout since we
+      # recorded it, so make sure it's still clean at `revision`.
+      if self._is_clean_checkout(revision):
+        LOGGER.debug('%r already checked out in %s (%s)',
+                     revision, self.checkout_dir, self.repo_url)
+        return
+      del self._CHECKOUT_CACHE[cache_key]
+
     LOGGER.info('Checking out %r in %s (%s)',
                 revision, self.checkout_dir, self.repo_url)
     self._ensure_local_repo_exists()
@@ -327,6 +353,8 @@ class GitBackend(Backend):
           LOGGER.warn('failed to remove %r, reset will fail: %s', index_lock, exc)
       self._git('reset', '-q', '--hard', revision)
 
+    self._CHECKOUT_CACHE[cache_key] = revision
+
   def cat_file(self, revision, file_path):
     self.assert_resolved(revision)
     return self._git('cat-file', 'blob', '%s:%s' % (revision, file_path))
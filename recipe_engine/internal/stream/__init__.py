@@ -27,14 +27,26 @@ from ..engine_step import StepConfig
 
 class StreamEngine(object):
   class Stream(object):
+    # Empty, so that subclasses may use __slots__ to avoid a per-instance
+    # __dict__.
+    __slots__ = ()
+
     def write_line(self, line):
       raise NotImplementedError()
 
+    def write_lines(self, lines):
+      """Write a sequence of lines (none of which may contain newlines) to the
+      stream.
+
+      Streams which can handle a batch of lines more cheaply than one
+      write_line call per line should override this."""
+      for line in lines:
+        self.write_line(line)
+
     def write_split(self, string):
       """Write a string (which may contain newlines) to the stream.  It will
       be terminated by a newline."""
-      for actual_line in string.splitlines() or ['']: # preserve empty lines
-        self.write_line(actual_line)
+      self.write_lines(string.splitlines() or ['']) # preserve empty lines
 
     # TODO(iannucci): Having a phantom method as part of the API is weird.
     # If there's a real filelike for this Stream, return it.
@@ -58,6 +70,8 @@ class StreamEngine(object):
       return ret
 
   class StepStream(Stream):
+    __slots__ = ()
+
     def new_log_stream(self, log_name):
       raise NotImplementedError()
 
@@ -2,7 +2,7 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
-import json
+import os
 
 from PB.go.chromium.org.luci.buildbucket.proto import common as common_pb2
 from PB.recipe_engine import result as result_pb2
@@ -13,6 +13,13 @@ from . import StreamEngine
 from .product import ProductStreamEngine
 
 
+# Set to '0' to skip wrapping stream engines with StreamEngineInvariants.
+INVARIANTS_ENV_VAR = 'LUCI_RECIPE_ENGINE_INVARIANTS'
+
+# frozenset of valid step statuses.
+_VALID_STATUSES = StepPresentation.STATUSES
+
+
 class StreamEngineInvariants(StreamEngine):
   """Checks that the users are using a StreamEngine hygenically.
 
@@ -23,9 +30,17 @@ class StreamEngineInvariants(StreamEngine):
     self._streams = set()
 
   @classmethod
-  def wrap(cls, other):
-    """Returns (ProductStreamEngine): A product applying invariants to "other".
+  def wrap(cls, other, invariants=None):
+    """Returns (StreamEngine): A product applying invariants to "other".
+
+    If invariants are disabled, "other" is returned as-is. By default they are
+    enabled unless python is running with `-O`, or
+    $LUCI_RECIPE_ENGINE_INVARIANTS is set to '0'.
     """
+    if invariants is None:
+      invariants = __debug__ and os.environ.get(INVARIANTS_ENV_VAR) != '0'
+    if not invariants:
+      return other
     return ProductStreamEngine(cls(), other)
 
   @property
@@ -39,41 +54,55 @@ class StreamEngineInvariants(StreamEngine):
       'expected terminal build status; got %s' % result.status)
 
   class StepStream(StreamEngine.StepStream):
+    __slots__ = ('_engine', '_step_name', '_open', '_log_names',
+                 '_log_streams', '_status')
+
     def __init__(self, engine, step_name):
       super(StreamEngineInvariants.StepStream, self).__init__()
       self._engine = engine
       self._step_name = step_name
       self._open = True
-      self._logs = {}
+      # Names of all logs in this step, and the LogStreams we opened for them
+      # (appended logs have no LogStream).
+      self._log_names = set()
+      self._log_streams = []
       self._status = 'SUCCESS'
 
     def write_line(self, line):
       assert '\n' not in line
       assert self._open
 
+    def write_lines(self, lines):
+      assert self._open
+      assert not any('\n' in line for line in lines), 'Newline in %r' % (lines,)
+
+    def write_split(self, string):
+      # splitlines already guarantees that there are no newlines.
+      assert self._open
+
     def close(self):
       assert self._open
-      for log_name, log in self._logs.iteritems():
-        if isinstance(log, self._engine.LogStream):
-          assert not log._open, 'Log %s still open when closing step %s' % (
-            log_name, self._step_name)
+      for log in self._log_streams:
+        assert not log._open, 'Log %s still open when closing step %s' % (
+          log._log_name, self._step_name)
       self._open = False
 
     def new_log_stream(self, log_name):
       assert self._open
-      assert log_name not in self._logs, 'Log %s already exists in step %s' % (
-        log_name, self._step_name)
+      assert log_name not in self._log_names, (
+        'Log %s already exists in step %s' % (log_name, self._step_name))
       ret = self._engine.LogStream(self, log_name)
-      self._logs[log_name] = ret
+      self._log_names.add(log_name)
+      self._log_streams.append(ret)
       return ret
 
     def append_log(self, log):
       assert self._open
       assert isinstance(log, common_pb2.Log), (
         'expected type common_pb2.Log; got type %s' % (type(log),))
-      assert log.name not in self._logs, 'Log %s already exists in step %s' % (
-        log.name, self._step_name)
-      self._logs[log.name] = None # The instance is not needed
+      assert log.name not in self._log_names, (
+        'Log %s already exists in step %s' % (log.name, self._step_name))
+      self._log_names.add(log.name)
 
     def add_step_text(self, text):
       pass
@@ -90,7 +119,7 @@ class StreamEngineInvariants(StreamEngine):
 
     def set_step_status(self, status, had_timeout):
       _ = had_timeout
-      assert status in StepPresentation.STATUSES, 'Unknown status %r' % status
+      assert status in _VALID_STATUSES, 'Unknown status %r' % status
       if status == 'SUCCESS':
         # A constraint imposed by the annotations implementation
         assert self._status == 'SUCCESS', (
@@ -101,6 +130,8 @@ class StreamEngineInvariants(StreamEngine):
       pass
 
   class LogStream(StreamEngine.Stream):
+    __slots__ = ('_step_stream', '_log_name', '_open')
+
     def __init__(self, step_stream, log_name):
       self._step_stream = step_stream
       self._log_name = log_name
@@ -111,6 +142,16 @@ class StreamEngineInvariants(StreamEngine):
       assert self._step_stream._open
       assert self._open
 
+    def write_lines(self, lines):
+      assert self._step_stream._open
+      assert self._open
+      assert not any('\n' in line for line in lines), 'Newline in %r' % (lines,)
+
+    def write_split(self, string):
+      # splitlines already guarantees that there are no newlines.
+      assert self._step_stream._open
+      assert self._open
+
     def close(self):
       assert self._step_stream._open
       assert self._open
@@ -126,6 +167,9 @@ class StreamEngineInvariants(StreamEngine):
           % (name_tokens,))
 
     name = '|'.join(name_tokens)
-    assert name not in self._streams, 'Step %r already exists' % (name,)
+    # Detect duplicates via the size of the set so that each step name is only
+    # hashed and probed once.
+    num_streams = len(self._streams)
     self._streams.add(name)
+    assert len(self._streams) > num_streams, 'Step %r already exists' % (name,)
     return self.StepStream(self, name)
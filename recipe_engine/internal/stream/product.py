@@ -32,6 +32,16 @@ class ProductStreamEngine(StreamEngine):
       self._stream_a.write_line(line)
       self._stream_b.write_line(line)
 
+    def write_lines(self, lines):
+      # Both streams consume the lines, so don't hand them a one-shot iterator.
+      lines = list(lines)
+      self._stream_a.write_lines(lines)
+      self._stream_b.write_lines(lines)
+
+    def write_split(self, string):
+      self._stream_a.write_split(string)
+      self._stream_b.write_split(string)
+
     def handle_exception(self, exc_type, exc_val, exc_tb):
       ret = self._stream_a.handle_exception(exc_type, exc_val, exc_tb)
       ret = ret or self._stream_b.handle_exception(exc_type, exc_val, exc_tb)
@@ -6,13 +6,15 @@
 
 import re
 
-from google.protobuf import json_format as json_pb
-
 from PB.go.chromium.org.luci.cv.api.recipe.v1 import cq as cq_pb2
 
 from recipe_engine import recipe_api
 
 
+_CQ_INPUT_PROP_KEY = '$recipe_engine/cq'
+_CQ_OUTPUT_PROP_KEY = '$recipe_engine/cq/output'
+
+
 class CQApi(recipe_api.RecipeApi):
   """This module provides recipe API of LUCI CQ, aka pre-commit testing system.
 
@@ -28,6 +30,10 @@ class CQApi(recipe_api.RecipeApi):
   QUICK_DRY_RUN = 'QUICK_DRY_RUN'
   FULL_RUN = 'FULL_RUN'
 
+  # Buildbucket tag keys set by CQ.
+  _CL_GROUP_KEY_TAG = 'cq_cl_group_key'
+  _EQUIVALENT_CL_GROUP_KEY_TAG = 'cq_equivalent_cl_group_key'
+
   class CQInactive(Exception):
     """Incorrect usage of CQApi method requiring active CQ."""
 
@@ -36,11 +42,18 @@ class CQApi(recipe_api.RecipeApi):
     self._input = input_props
     self._active = False
     self._output = cq_pb2.Output()
+    # str versions of self._output.triggered_build_ids, kept in sync with it.
+    self._triggered_build_id_strs = []
+    # Lazily populated mapping of buildbucket tag key -> first value.
+    self._tag_cache = None
 
   def initialize(self):
+    if not self._input.active and _CQ_INPUT_PROP_KEY not in self.m.properties:
+      # Not a CQ build; this is the common case.
+      return
     if self._input.active or (
       # legacy style
-      'dry_run' in self.m.properties.get('$recipe_engine/cq', {})):
+      'dry_run' in self.m.properties[_CQ_INPUT_PROP_KEY]):
       self._active = True
     if self._active and not self._input.run_mode:
       # backfill
@@ -124,11 +137,13 @@ class CQApi(recipe_api.RecipeApi):
     """
     if not self._input.active:
       return {}
-    msg = cq_pb2.Input()
-    msg.CopyFrom(self._input)
-    msg.top_level = False
-    return {'$recipe_engine/cq':
-        json_pb.MessageToDict(msg, preserving_proto_field_name=True)}
+    # late import; json_format is only needed when scheduling child builds.
+    from google.protobuf import json_format as json_pb
+    props = json_pb.MessageToDict(
+        self._input, preserving_proto_field_name=True)
+    # top_level=False is the proto default, so it's omitted from the dict.
+    props.pop('top_level', None)
+    return {_CQ_INPUT_PROP_KEY: props}
 
   @property
   def cl_group_key(self):
@@ -141,7 +156,7 @@ class CQApi(recipe_api.RecipeApi):
     Raises:
       CQInactive if CQ is not active for this build.
     """
-    return self._extract_unique_cq_tag('cl_group_key')
+    return self._extract_unique_cq_tag(self._CL_GROUP_KEY_TAG)
 
   @property
   def equivalent_cl_group_key(self):
@@ -154,12 +169,12 @@ class CQApi(recipe_api.RecipeApi):
     Raises:
       CQInactive if CQ is not active for this build.
     """
-    return self._extract_unique_cq_tag('equivalent_cl_group_key')
+    return self._extract_unique_cq_tag(self._EQUIVALENT_CL_GROUP_KEY_TAG)
 
   @property
   def triggered_build_ids(self):
     """Returns recorded Buildbucket build IDs as a list of integers."""
-    return [bid for bid in self._output.triggered_build_ids]
+    return list(self._output.triggered_build_ids)
 
   def record_triggered_builds(self, *builds):
     """Adds given Buildbucket builds to the list of triggered builds for CQ
@@ -189,11 +204,11 @@ class CQApi(recipe_api.RecipeApi):
     """
     if not build_ids:
       return
-    self._output.triggered_build_ids.extend(int(bid) for bid in build_ids)
+    build_ids = [int(bid) for bid in build_ids]
+    self._output.triggered_build_ids.extend(build_ids)
+    self._triggered_build_id_strs.extend(str(bid) for bid in build_ids)
     self._write_output_props(
-      triggered_build_ids=[
-        str(bid) for bid in self._output.triggered_build_ids
-      ],
+      triggered_build_ids=self._triggered_build_id_strs,
     )
 
   @property
@@ -208,9 +223,12 @@ class CQApi(recipe_api.RecipeApi):
     """
     if self._output.retry == cq_pb2.Output.OUTPUT_RETRY_DENIED:
       return
+    # Run the step first, so that the previous step (which may hold a
+    # reference to self._output) is finalized before self._output changes.
+    cur_step = self.m.step('TRYJOB DO NOT RETRY', cmd=None)
     self._output.retry = cq_pb2.Output.OUTPUT_RETRY_DENIED
     self._write_output_props(
-      cur_step= self.m.step('TRYJOB DO NOT RETRY', cmd=None),
+      cur_step=cur_step,
       do_not_retry=True,
     )
 
@@ -241,24 +259,28 @@ class CQApi(recipe_api.RecipeApi):
         cq_pb2.Output.Reuse(mode_regexp=mr) for mr in mode_regexps)
     self._write_output_props()
 
-  def _extract_unique_cq_tag(self, suffix):
-    key = 'cq_' + suffix
+  def _extract_unique_cq_tag(self, key):
     self._enforce_active()
-    for t in self.m.buildbucket.build.tags:
-      if t.key == key:
-        return t.value
-    raise ValueError('Can\'t find tag with key %r' % key)  # pragma: nocover
+    if self._tag_cache is None:
+      self._tag_cache = {}
+      for t in self.m.buildbucket.build.tags:
+        self._tag_cache.setdefault(t.key, t.value)
+    try:
+      return self._tag_cache[key]
+    except KeyError:  # pragma: nocover
+      raise ValueError('Can\'t find tag with key %r' % key)
 
   def _write_output_props(self, cur_step=None, **addition_props):
     # TODO(iannucci): add API to set properties regardless of the current step.
     if not cur_step:
       cur_step = self.m.step.active_result
       assert cur_step, 'must be called after some step'
-    output = cq_pb2.Output()
-    output.CopyFrom(self._output)
-    cur_step.presentation.properties['$recipe_engine/cq/output'] = output
-    for k, v in addition_props.iteritems():
-      cur_step.presentation.properties[k] = v
+    # Properties are only serialized when the step is finalized, so storing
+    # self._output itself (rather than a copy) captures its final state.
+    props = cur_step.presentation.properties
+    props[_CQ_OUTPUT_PROP_KEY] = self._output
+    if addition_props:
+      props.update(addition_props)
 
   def _enforce_active(self):
     if not self._active:
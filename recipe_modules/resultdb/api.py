@@ -8,6 +8,9 @@ Requires `rdb` command in `$PATH`:
 https://godoc.org/go.chromium.org/luci/resultdb/cmd/rdb
 """
 
+import contextlib
+import itertools
+
 from google.protobuf import json_format
 from recipe_engine import recipe_api
 
@@ -22,6 +25,9 @@ class ResultDBAPI(recipe_api.RecipeApi):
   # Maximum number of requests in a batch RPC.
   _BATCH_SIZE = 500
 
+  # Maximum number of batch RPCs in flight at once.
+  _MAX_CONCURRENT_BATCHES = 8
+
   # Prefix of an invocation name.
   _INVOCATION_NAME_PREFIX  = 'invocations/'
 
@@ -30,9 +36,21 @@ class ResultDBAPI(recipe_api.RecipeApi):
   deserialize = staticmethod(common.deserialize)
   Invocation = common.Invocation
 
+  def __init__(self, **kwargs):
+    super(ResultDBAPI, self).__init__(**kwargs)
+    # (set of ids to add, set of ids to remove) while inside batched_updates.
+    self._update_buffer = None
+    # The build doesn't change during the recipe run, so these are looked up
+    # lazily, once.
+    self._current_invocation = None
+    self._builder_realm = None
+
   @property
   def current_invocation(self):
-    return self.m.buildbucket.build.infra.resultdb.invocation
+    if self._current_invocation is None:
+      self._current_invocation = (
+          self.m.buildbucket.build.infra.resultdb.invocation)
+    return self._current_invocation
 
   @property
   def enabled(self):
@@ -54,6 +72,36 @@ class ResultDBAPI(recipe_api.RecipeApi):
     return self.update_included_invocations(
         remove_invocations=invocations, step_name=step_name)
 
+  @contextlib.contextmanager
+  def batched_updates(self, step_name=None):
+    """Coalesces updates of included invocations into a single RPC.
+
+    Within this context, include_invocations, exclude_invocations and
+    update_included_invocations only record the requested changes. On exit,
+    all of them are sent in a single UpdateIncludedInvocations RPC. An id which
+    is both added and removed by one call is ignored, as outside of a batch. If
+    different calls add and remove the same id, the last call wins.
+
+    Example:
+      with api.resultdb.batched_updates():
+        for shard in shards:
+          api.resultdb.include_invocations(shard.invocation_ids)
+
+    Args:
+      step_name (str): name of the step issuing the RPC.
+    """
+    assert self._update_buffer is None, 'batched_updates may not be nested'
+    self._update_buffer = (set(), set())
+    try:
+      yield
+      to_add, to_remove = self._update_buffer
+    finally:
+      self._update_buffer = None
+    self.update_included_invocations(
+        add_invocations=sorted(to_add),
+        remove_invocations=sorted(to_remove),
+        step_name=step_name)
+
   def update_included_invocations(self,
                                   add_invocations=None,
                                   remove_invocations=None,
@@ -67,26 +115,44 @@ class ResultDBAPI(recipe_api.RecipeApi):
           current invocation.
 
     This updates the inclusions of the current invocation specified in the
-    LUCI_CONTEXT.
+    LUCI_CONTEXT. Duplicate ids are ignored, as are ids which are both added
+    and removed. If nothing is left to update, no RPC is made.
+
+    Within batched_updates, the changes are recorded and step_name is ignored.
     """
     self.assert_enabled()
 
-    if not (add_invocations or remove_invocations):
+    to_add = set(add_invocations or ())
+    to_remove = set(remove_invocations or ())
+    # Adding and removing the same invocation is contradictory; do neither.
+    overlap = to_add & to_remove
+    to_add -= overlap
+    to_remove -= overlap
+
+    if self._update_buffer is not None:
+      # A later call overrides what earlier calls in the batch requested.
+      buf_add, buf_remove = self._update_buffer
+      buf_add.difference_update(to_remove)
+      buf_add.update(to_add)
+      buf_remove.difference_update(to_add)
+      buf_remove.update(to_remove)
+      return
+
+    if not (to_add or to_remove):
       # Nothing to do.
       return
 
-    names = lambda ids: ['invocations/%s' % id for id in ids or []]
+    prefix = self._INVOCATION_NAME_PREFIX
     req = recorder.UpdateIncludedInvocationsRequest(
-        including_invocation=self.current_invocation,
-        add_invocations=names(add_invocations),
-        remove_invocations=names(remove_invocations),
-    )
+        including_invocation=self.current_invocation)
+    req.add_invocations.extend(prefix + id for id in sorted(to_add))
+    req.remove_invocations.extend(prefix + id for id in sorted(to_remove))
 
     self._rpc(
         step_name or 'resultdb.update_included_invocations',
         'luci.resultdb.v1.Recorder',
         'UpdateIncludedInvocations',
-        json_format.MessageToDict(req),
+        req,
         include_update_token=True,
         step_test_data=lambda: self.m.raw_io.test_api.stream_output('{}'))
 
@@ -98,39 +164,53 @@ class ResultDBAPI(recipe_api.RecipeApi):
       step_name (str): name of the step.
     """
 
-    def args(test_exonerations, step_name):
+    if not test_exonerations:
+      return
+
+    self.assert_enabled()
+    step_name = step_name or 'resultdb.exonerate'
+
+    invocation = self.current_invocation
+    requests = [
+        recorder.CreateTestExonerationRequest(test_exoneration=te)
+        for te in test_exonerations
+    ]
+
+    def args(batch, step_name):
       req = recorder.BatchCreateTestExonerationsRequest(
-          invocation=self.current_invocation,
+          invocation=invocation,
+          # Each batch needs its own request id.
           request_id=self.m.uuid.random(),
+          requests=batch,
       )
-      for te in test_exonerations:
-        req.requests.add(test_exoneration=te)
-
       return [
           step_name, 'luci.resultdb.v1.Recorder', 'BatchCreateTestExonerations',
-          json_format.MessageToDict(req),
+          req,
           True, lambda: self.m.raw_io.test_api.stream_output('{}')
       ]
 
-    if not test_exonerations:
-      return
-
-    self.assert_enabled()
-    step_name = step_name or 'resultdb.exonerate'
-
     if len(test_exonerations) <= self._BATCH_SIZE:
-      self._rpc(*args(test_exonerations, step_name))
+      self._rpc(*args(requests, step_name))
       return
 
-    # Sends requests in batches.
-    remaining = test_exonerations
-    i = 0
+    # Sends requests in batches, with at most _MAX_CONCURRENT_BATCHES of them
+    # in flight at a time.
+    it = iter(requests)
+    batches = iter(lambda: list(itertools.islice(it, self._BATCH_SIZE)), [])
+    futures = []
+    in_flight = []
     with self.m.step.nest(step_name):
-      while remaining:
-        batch = remaining[:self._BATCH_SIZE]
-        remaining = remaining[self._BATCH_SIZE:]
-        self.m.futures.spawn(self._rpc, *args(batch, 'batch (%d)' % i))
-        i += 1
+      for i, batch in enumerate(batches):
+        if len(in_flight) >= self._MAX_CONCURRENT_BATCHES:
+          self.m.futures.wait(in_flight, count=1)
+          in_flight = [f for f in in_flight if not f.done]
+        future = self.m.futures.spawn(self._rpc, *args(batch, 'batch (%d)' % i))
+        futures.append(future)
+        in_flight.append(future)
+
+      # Raise the first failure, if any.
+      for future in futures:
+        future.result()
 
   def invocation_ids(self, inv_names):
     """Returns invocation ids by parsing invocation names.
@@ -141,11 +221,11 @@ class ResultDBAPI(recipe_api.RecipeApi):
     Returns:
       A list of invocation_ids.
     """
-    assert all(isinstance(name, str) for name in inv_names), inv_names
-    assert all(name.startswith(
-        self._INVOCATION_NAME_PREFIX) for name in inv_names), inv_names
+    prefix = self._INVOCATION_NAME_PREFIX
+    assert all(isinstance(name, str) and name.startswith(prefix)
+               for name in inv_names), inv_names
 
-    return [name[len(self._INVOCATION_NAME_PREFIX):] for name in inv_names]
+    return [name[len(prefix):] for name in inv_names]
 
   def query(self,
             inv_ids,
@@ -220,7 +300,7 @@ class ResultDBAPI(recipe_api.RecipeApi):
       service (string): the full name of a service, e.g.
         "luci.resultdb.v1.ResultDB".
       method (string): the name of the method, e.g. "GetInvocation".
-      req (dict): request message.
+      req (message): request message.
       include_update_token (bool): A flag to indicate if the RPC requires the
         update token of the invocation.
 
@@ -235,12 +315,19 @@ class ResultDBAPI(recipe_api.RecipeApi):
         subcommand='rpc',
         step_name=step_name,
         args=args,
-        stdin=self.m.json.input(req),
+        stdin=self.m.raw_io.input_text(
+            json_format.MessageToJson(req, indent=None, sort_keys=True)),
         stdout=self.m.json.output(),
         step_test_data=step_test_data,
     )
     return step_res.stdout
 
+  def _get_builder_realm(self):
+    """Returns the (cached) LUCI realm of the current build."""
+    if self._builder_realm is None:
+      self._builder_realm = self.m.buildbucket.builder_realm
+    return self._builder_realm
+
   def _run_rdb(self,
                subcommand,
                step_name=None,
@@ -312,38 +399,39 @@ class ResultDBAPI(recipe_api.RecipeApi):
     """
     if require_build_inv:
       self.assert_enabled()
-    assert isinstance(test_id_prefix, (type(None), str)), test_id_prefix
-    assert isinstance(base_variant, (type(None), dict)), base_variant
-    assert isinstance(cmd, (tuple, list)), cmd
-    assert isinstance(test_location_base, (type(None), str)), test_location_base
-    assert not test_location_base or test_location_base.startswith(
-        '//'), test_location_base
-    assert isinstance(base_tags, (type(None), list)), base_tags
-    assert isinstance(coerce_negative_duration, bool), coerce_negative_duration
-    assert isinstance(include, bool), include
-    assert isinstance(realm, (type(None), str)), realm
-    assert isinstance(location_tags_file, (type(None), str)), location_tags_file
+    if __debug__:
+      _validate_wrap_args(cmd, test_id_prefix, base_variant, test_location_base,
+                          base_tags, coerce_negative_duration, include, realm,
+                          location_tags_file)
 
     ret = ['rdb', 'stream']
 
     if test_id_prefix:
       ret += ['-test-id-prefix', test_id_prefix]
 
-    for k, v in sorted((base_variant or {}).iteritems()):
-      ret += ['-var', '%s:%s' % (k, v)]
+    if not (base_variant or test_location_base or base_tags or
+            coerce_negative_duration or include or location_tags_file):
+      # Fast path for the common case of no other options.
+      ret += ['--'] + list(cmd)
+      return ret
+
+    ret.extend(
+        arg for k, v in sorted((base_variant or {}).items())
+        for arg in ('-var', '%s:%s' % (k, v)))
 
     if test_location_base:
       ret += ['-test-location-base', test_location_base]
 
-    for k, v in sorted(base_tags or []):
-      ret += ['-tag', '%s:%s' % (k, v)]
+    ret.extend(
+        arg for k, v in sorted(base_tags or [])
+        for arg in ('-tag', '%s:%s' % (k, v)))
 
     if coerce_negative_duration:
       ret += ['-coerce-negative-duration']
 
     if include:
       ret += [
-          '-new', '-realm', realm or self.m.buildbucket.builder_realm,
+          '-new', '-realm', realm or self._get_builder_realm(),
           '-include'
       ]
 
@@ -395,3 +483,20 @@ class ResultDBAPI(recipe_api.RecipeApi):
       'column_keys': column_keys,
       'grouping_keys': grouping_keys,
     }
+
+
+def _validate_wrap_args(cmd, test_id_prefix, base_variant, test_location_base,
+                        base_tags, coerce_negative_duration, include, realm,
+                        location_tags_file):
+  """Asserts that the arguments of ResultDBAPI.wrap are well-formed."""
+  assert isinstance(test_id_prefix, (type(None), str)), test_id_prefix
+  assert isinstance(base_variant, (type(None), dict)), base_variant
+  assert isinstance(cmd, (tuple, list)), cmd
+  assert isinstance(test_location_base, (type(None), str)), test_location_base
+  assert not test_location_base or test_location_base.startswith(
+      '//'), test_location_base
+  assert isinstance(base_tags, (type(None), list)), base_tags
+  assert isinstance(coerce_negative_duration, bool), coerce_negative_duration
+  assert isinstance(include, bool), include
+  assert isinstance(realm, (type(None), str)), realm
+  assert isinstance(location_tags_file, (type(None), str)), location_tags_file
@@ -56,7 +56,7 @@ def serialize(inv_bundle, pretty=False):
         json.dumps(jsonish, sort_keys=True, indent=2 if pretty else None)
     )
 
-  for inv_id, inv in inv_bundle.iteritems():
+  for inv_id, inv in inv_bundle.items():
     assert isinstance(inv, Invocation), inv
     if inv.proto.ListFields():  # if something is set
       add_line(inv_id, 'invocation', inv.proto)
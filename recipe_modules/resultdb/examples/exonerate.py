@@ -35,6 +35,8 @@ test_exonerations = [
 
 def RunSteps(api):
   api.resultdb._BATCH_SIZE = api.properties.get('batch_size', 500)
+  api.resultdb._MAX_CONCURRENT_BATCHES = api.properties.get(
+      'max_concurrent_batches', 8)
   api.resultdb.exonerate(
       test_exonerations=api.properties.get('test_exonerations',
                                            test_exonerations),
@@ -48,7 +50,8 @@ def GenTests(api):
       api.post_process(DropExpectation))
 
   yield api.test(
-      'exonerate in multiple batches', api.properties(batch_size=1),
+      'exonerate in multiple batches',
+      api.properties(batch_size=1, max_concurrent_batches=1),
       api.buildbucket.ci_build(),
       api.post_process(StepSuccess, 'exonerate without patch failures'),
       api.post_process(StepSuccess,
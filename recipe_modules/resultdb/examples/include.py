@@ -2,14 +2,17 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import json
+
 from recipe_engine.post_process import (DropExpectation, StepSuccess,
-  DoesNotRunRE)
+  DoesNotRun, DoesNotRunRE, MustRun)
 
 from PB.go.chromium.org.luci.buildbucket.proto import build as build_pb2
 from PB.go.chromium.org.luci.resultdb.proto.v1 import invocation as invocation_pb2
 
 DEPS = [
   'buildbucket',
+  'properties',
   'resultdb',
 ]
 
@@ -21,11 +24,31 @@ def RunSteps(api):
     variants_with_unexpected_results=True,
   )
   invocation_ids = inv_bundle.keys()
-  api.resultdb.include_invocations(invocation_ids, step_name='rdb include')
-  api.resultdb.exclude_invocations(invocation_ids, step_name='rdb exclude')
+  if api.properties.get('batched'):
+    with api.resultdb.batched_updates(step_name='rdb update'):
+      api.resultdb.include_invocations(invocation_ids)
+      api.resultdb.exclude_invocations(['invid2'])
+      api.resultdb.include_invocations(['invid3'])
+      # Contradictory within a single call, so ignored.
+      api.resultdb.update_included_invocations(
+          add_invocations=['invid4'], remove_invocations=['invid4'])
+  elif api.properties.get('overlap'):
+    api.resultdb.update_included_invocations(
+        add_invocations=invocation_ids,
+        remove_invocations=invocation_ids,
+        step_name='rdb update')
+  else:
+    api.resultdb.include_invocations(invocation_ids, step_name='rdb include')
+    api.resultdb.exclude_invocations(invocation_ids, step_name='rdb exclude')
 
 
 def GenTests(api):
+  def check_batched_request(check, steps):
+    req = json.loads(steps['rdb update'].stdin)
+    check(req['addInvocations'] == [
+        'invocations/invid', 'invocations/invid3'])
+    check(req['removeInvocations'] == ['invocations/invid2'])
+
   yield (
     api.test('noop') +
     api.buildbucket.ci_build() +
@@ -52,3 +75,27 @@ def GenTests(api):
         inv_bundle,
         step_name='rdb query')
   )
+
+  yield (
+    api.test('batched') +
+    api.properties(batched=True) +
+    api.buildbucket.ci_build() +
+    api.resultdb.query(
+        inv_bundle,
+        step_name='rdb query') +
+    api.post_process(MustRun, 'rdb update') +
+    api.post_process(check_batched_request) +
+    api.post_process(DoesNotRunRE, 'rdb include', 'rdb exclude') +
+    api.post_process(DropExpectation)
+  )
+
+  yield (
+    api.test('overlap') +
+    api.properties(overlap=True) +
+    api.buildbucket.ci_build() +
+    api.resultdb.query(
+        inv_bundle,
+        step_name='rdb query') +
+    api.post_process(DoesNotRun, 'rdb update') +
+    api.post_process(DropExpectation)
+  )
@@ -6,7 +6,7 @@ DEPS = [
     'cipd',
     'context',
     'file',
-    'json',
+    'futures',
     'path',
     'properties',
     'step',
@@ -29,6 +29,9 @@ class TriciumApi(recipe_api.RecipeApi):
   LegacyAnalyzer = legacy_analyzers.LegacyAnalyzer
   analyzers = legacy_analyzers.Analyzers
 
+  # Maximum number of legacy analyzers to run concurrently in run_legacy.
+  _MAX_PARALLEL_ANALYZERS = 8
+
   def __init__(self, **kwargs):
     """Sets up the API.
 
@@ -37,6 +40,12 @@ class TriciumApi(recipe_api.RecipeApi):
     """
     super(TriciumApi, self).__init__(**kwargs)
     self._comments = []
+    # Serialized form of each comment in self._comments, for deduplication.
+    self._comment_keys = set()
+    # Maps (package, version) to (Future of the CIPD fetch, package dir).
+    self._package_fetches = {}
+    # Data dirs already created by _ensure_data_dir.
+    self._ensured_data_dirs = set()
 
   def add_comment(self,
                   category,
@@ -48,21 +57,23 @@ class TriciumApi(recipe_api.RecipeApi):
                   end_char=0,
                   suggestions=()):
     """Adds one comment to accumulate."""
-    comment = Data.Comment()
-    comment.category = category
-    comment.message = message
-    comment.path = path
-    comment.start_line = start_line
-    comment.end_line = end_line
-    comment.start_char = start_char
-    comment.end_char = end_char
-    for s in suggestions:
-      # Convert from dict to proto message by way of JSON.
-      json_format.Parse(self.m.json.dumps(s), comment.suggestions.add())
+    comment = Data.Comment(
+        category=category,
+        message=message,
+        path=path,
+        start_line=start_line,
+        end_line=end_line,
+        start_char=start_char,
+        end_char=end_char,
+        # Convert from dict to proto message.
+        suggestions=[json_format.ParseDict(s, Data.Suggestion())
+                     for s in suggestions])
     self._add_comment(comment)
 
   def _add_comment(self, comment):
-    if comment not in self._comments:
+    key = comment.SerializeToString(deterministic=True)
+    if key not in self._comment_keys:
+      self._comment_keys.add(key)
       self._comments.append(comment)
 
   def write_comments(self):
@@ -82,7 +93,7 @@ class TriciumApi(recipe_api.RecipeApi):
           'are too many in changed lines.' % num_comments)
       return
     # The "tricium" output property is read by the Tricium service.
-    results_json = json_format.MessageToJson(results, indent=0)
+    results_json = self._results_to_json(results, indent=0)
     step.presentation.properties['tricium'] = results_json
 
   def run_legacy(self,
@@ -113,9 +124,10 @@ class TriciumApi(recipe_api.RecipeApi):
         analyzers.
     """
     self._write_files_data(affected_files, commit_message, input_base)
-    # For each analyzer, download the CIPD package, run it and accumulate
-    # results. Note: Each analyzer could potentially be run in parallel.
-    for analyzer in analyzers:
+
+    def _run_one(analyzer):
+      """Downloads the CIPD package for one analyzer, runs it and returns its
+      results, or None if it failed."""
       with self.m.step.nest(analyzer.name) as parent_step:
         # Check analyzer.path_filters and conditionally skip.
         if not _matches_path_filters(affected_files, analyzer.path_filters):
@@ -124,7 +136,7 @@ class TriciumApi(recipe_api.RecipeApi):
           analyzer_dir = self.m.path['cleanup'].join(analyzer.name)
           output_base = analyzer_dir.join('out')
           package_dir = analyzer_dir.join('package')
-          self._fetch_legacy_analyzer(package_dir, analyzer)
+          package_dir = self._fetch_legacy_analyzer(package_dir, analyzer)
           results = self._run_legacy_analyzer(
               package_dir,
               analyzer,
@@ -132,21 +144,48 @@ class TriciumApi(recipe_api.RecipeApi):
               output_dir=output_base)
           # Show step results. If there are too many comments, don't include
           # them. If one analyzer fails, continue running the rest.
-          for comment in results.comments:
-            self._add_comment(comment)
           num_comments = len(results.comments)
           parent_step.presentation.step_text = '%s comment(s)' % num_comments
-          parent_step.presentation.logs['result'] = json_format.MessageToJson(
+          parent_step.presentation.logs['result'] = self._results_to_json(
               results)
+          return results
         except self.m.step.StepFailure:
           parent_step.presentation.step_text = 'failed'
+          return None
+
+    # Run the analyzers concurrently, with at most _MAX_PARALLEL_ANALYZERS of
+    # them in flight at once.
+    futures = []
+    in_flight = []
+    for analyzer in analyzers:
+      if len(in_flight) >= self._MAX_PARALLEL_ANALYZERS:
+        self.m.futures.wait(in_flight, count=1)
+        in_flight = [f for f in in_flight if not f.done]
+      future = self.m.futures.spawn(_run_one, analyzer)
+      futures.append(future)
+      in_flight.append(future)
+    # Accumulate comments in analyzer order so that the output is
+    # deterministic.
+    for future in futures:
+      results = future.result()
+      if results is not None:
+        for comment in results.comments:
+          self._add_comment(comment)
     # The tricium data dir with files.json is written in the checkout cache
     # directory and should be cleaned up.
     self.m.file.rmtree('clean up tricium data dir', input_base.join('tricium'))
+    self._ensured_data_dirs.discard(str(input_base.join('tricium', 'data')))
 
     if emit:
       self.write_comments()
 
+  def _results_to_json(self, results, indent=2):
+    """Returns the JSON form of a Results message."""
+    if not results.ByteSize():
+      # Empty results, e.g. from an analyzer which found nothing.
+      return '{}'
+    return json_format.MessageToJson(results, indent=indent)
+
   def _write_files_data(self, affected_files, commit_message, base_dir):
     """Writes a Files input message to a file.
 
@@ -156,17 +195,14 @@ class TriciumApi(recipe_api.RecipeApi):
       * commit_message (str): The commit message from Gerrit.
       * base_dir (Path): Input files base directory.
     """
-    files = Data.Files()
-    files.commit_message = commit_message
-    for path in affected_files:
-      # TODO(qyearsley): Set the is_binary and status fields for each file.
-      # Analyzers use these fields to determine whether to skip files.
-      f = files.files.add()
-      f.path = path
+    files = Data.Files(commit_message=commit_message)
+    # TODO(qyearsley): Set the is_binary and status fields for each file.
+    # Analyzers use these fields to determine whether to skip files.
+    files.files.extend(Data.File(path=path) for path in affected_files)
     data_dir = self._ensure_data_dir(base_dir)
     # Note: The JSON written self.m.file.write_proto doesn't work for what
     # Tricium analyzers expect, but json_format.MessageToJson does.
-    files_json = json_format.MessageToJson(files)
+    files_json = json_format.MessageToJson(files, indent=None)
     self.m.file.write_text('write files.json', data_dir.join('files.json'),
                            files_json)
 
@@ -192,6 +228,8 @@ class TriciumApi(recipe_api.RecipeApi):
     Simple Tricium analyzers assume that data is input/output from a
     particular subpath relative to the input/output paths passed.
 
+    Each directory is only ensured once, until run_legacy cleans it up.
+
     Args:
       * base_dir (Path): A directory, could be either the -input
         or -output passed to a Tricium analyzer.
@@ -199,19 +237,44 @@ class TriciumApi(recipe_api.RecipeApi):
     Returns: Tricium data file directory inside base_dir.
     """
     data_dir = base_dir.join('tricium', 'data')
-    self.m.file.ensure_directory('ensure tricium data dir', data_dir)
+    key = str(data_dir)
+    if key not in self._ensured_data_dirs:
+      self.m.file.ensure_directory('ensure tricium data dir', data_dir)
+      self._ensured_data_dirs.add(key)
     return data_dir
 
   def _fetch_legacy_analyzer(self, package_dir, analyzer):
     """Fetches an analyzer package from CIPD.
 
+    Each package is only fetched once per recipe run; analyzers sharing a
+    package reuse the directory it was first fetched to. Failed fetches are
+    not reused.
+
     Args:
       * packages_dir (Path): The path to fetch to.
       * analyzer (LegacyAnalyzer): Analyzer package to fetch.
+
+    Returns: The Path the package was fetched to.
     """
-    ensure_file = self.m.cipd.EnsureFile()
-    ensure_file.add_package(analyzer.package, version='live')
-    self.m.cipd.ensure(package_dir, ensure_file)
+    key = (analyzer.package, 'live')
+    if key not in self._package_fetches:
+      ensure_file = self.m.cipd.EnsureFile()
+      ensure_file.add_package(analyzer.package, version='live')
+      # Stored as a future so that concurrently running analyzers sharing the
+      # package wait for the same fetch.
+      self._package_fetches[key] = (
+          self.m.futures.spawn(self.m.cipd.ensure, package_dir, ensure_file),
+          package_dir)
+    fetch, fetched_dir = self._package_fetches[key]
+    try:
+      fetch.result()
+    except self.m.step.StepFailure:
+      # Forget the failed fetch so that later analyzers retry it, unless one
+      # of them already did.
+      if self._package_fetches.get(key, (None,))[0] is fetch:
+        del self._package_fetches[key]
+      raise
+    return fetched_dir
 
   def _run_legacy_analyzer(self, package_dir, analyzer, input_dir, output_dir):
     """Runs a simple legacy analyzer executable and returns the results.
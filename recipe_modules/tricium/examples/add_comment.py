@@ -18,7 +18,7 @@ def RunSteps(api, trigger_type_error):
   # Duplicate comments aren't entered.
   api.tricium.add_comment('test', 'test message', filename)
 
-  # Suggestions are given as JSON.
+  # Suggestions are given as dicts in the JSON form of Data.Suggestion.
   suggestions = [{'description': 'please fix this'}]
 
   api.tricium.add_comment(
@@ -13,6 +13,7 @@ from PB.tricium.data import Data
 DEPS = [
     'file',
     'path',
+    'properties',
     'tricium',
 ]
 
@@ -30,10 +31,26 @@ def RunSteps(api):
   ]
   # Analyzers can also be added via their names:
   analyzers.append(api.tricium.analyzers.by_name()['Eslint'])
+  if api.properties.get('shared_package'):
+    # Analyzers sharing a CIPD package only fetch it once.
+    analyzers.append(
+        api.tricium.LegacyAnalyzer(
+            name='Spacey-extra',
+            package=api.tricium.analyzers.SPACEY.package,
+            executable=api.tricium.analyzers.SPACEY.executable,
+            extra_args=['-extra']))
+
+  api.tricium._MAX_PARALLEL_ANALYZERS = api.properties.get(
+      'max_parallel_analyzers', 8)
 
   api.tricium.run_legacy(
       analyzers, checkout_base, ['one.py', 'foo/two.py'], commit_message='msg')
 
+  if api.properties.get('rerun'):
+    api.tricium.run_legacy([api.tricium.analyzers.SPACEY],
+                           checkout_base, ['one.py'],
+                           commit_message='msg')
+
 
 def GenTests(api):
 
@@ -50,6 +67,42 @@ def GenTests(api):
          api.post_check(post_process.StatusSuccess) +
          api.post_process(post_process.DropExpectation))
 
+  yield (api.test('serial') + api.properties(max_parallel_analyzers=1) +
+         api.step_data(
+             'Pylint.read results',
+             api.file.read_text(results_json(num_comments=1))) +
+         api.post_check(post_process.StatusSuccess) +
+         api.post_process(post_process.DropExpectation))
+
+  yield (api.test('shared_package') + api.properties(shared_package=True) +
+         api.post_check(post_process.MustRun, 'Spacey.ensure_installed',
+                        'Spacey-extra.run analyzer') +
+         api.post_check(post_process.DoesNotRun,
+                        'Spacey-extra.ensure_installed') +
+         api.post_process(post_process.DropExpectation))
+
+  yield (api.test('shared_package_fetch_failure') +
+         api.properties(shared_package=True, max_parallel_analyzers=1) +
+         api.step_data('Spacey.ensure_installed', retcode=1) +
+         # The failed fetch isn't reused by the next analyzer sharing it.
+         api.post_check(post_process.MustRun, 'Spacey-extra.ensure_installed',
+                        'Spacey-extra.run analyzer') +
+         api.post_process(post_process.DropExpectation))
+
+  yield (api.test('rerun_after_fetch_failure') + api.properties(rerun=True) +
+         api.step_data('Spacey.ensure_installed', retcode=1) +
+         api.post_check(post_process.MustRun, 'Spacey (2).ensure_installed',
+                        'Spacey (2).run analyzer') +
+         api.post_process(post_process.DropExpectation))
+
+  yield (api.test('rerun') + api.properties(rerun=True) +
+         # The input data dir is cleaned up after each run, so it's recreated.
+         api.post_check(post_process.MustRun, 'ensure tricium data dir (2)') +
+         api.post_check(post_process.DoesNotRun,
+                        'Spacey (2).ensure tricium data dir') +
+         api.post_check(post_process.MustRun, 'Spacey (2).read results') +
+         api.post_process(post_process.DropExpectation))
+
   yield (api.test('with_failure') +
          api.step_data('Spacey.run analyzer', retcode=1) +
          api.post_process(post_process.DropExpectation))
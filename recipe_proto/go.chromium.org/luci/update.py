@@ -1,4 +1,4 @@
-#!/usr/bin/env vpython
+#!/usr/bin/env vpython3
 # Copyright 2019 The LUCI Authors. All rights reserved.
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
@@ -9,15 +9,30 @@ This is not necessarily used for all proto files in this directory;
 but should update those listed in SUB_PATHS.
 """
 
+# [VPYTHON:BEGIN]
+# python_version: "3.8"
+# wheel: <
+#   name: "infra/python/wheels/urllib3-py2_py3"
+#   version: "version:1.22"
+# >
+# wheel: <
+#   name: "infra/python/wheels/requests-py2_py3"
+#   version: "version:2.13.0"
+# >
+# [VPYTHON:END]
+
+import io
 import json
 import os
 import tarfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 
 BASE_URL = 'https://chromium.googlesource.com/infra/luci/luci-go'
-LOG_URL = BASE_URL+'/+log/master/%s?format=JSON&n=1'
-TAR_URL = BASE_URL+'/+archive/%s/%s.tar.gz'
 
 SUB_PATHS = [
   'buildbucket/proto',
@@ -30,39 +45,232 @@ SUB_PATHS = [
   'scheduler/api/scheduler/v1',
 ]
 
+# Maximum number of threads writing out the files of one archive.
+MAX_WRITERS = 8
+
+# Chunk size used to download each archive.
+COPY_BUFSIZE = 1 << 20
+
+# Downloaded archives are cached here, by sub path and commit.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'luci-update')
+
+# Number of archives to keep in the cache for each sub path.
+CACHE_KEEP = 2
+
+# Caches the ETag of the last log response for each sub path, next to this
+# script. Not checked in.
+ETAGS_FILE = '.update_etags.json'
+
+# All requests go to the same host; share pooled, kept-alive connections
+# between the threads updating each sub path.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1, pool_maxsize=len(SUB_PATHS)))
+
+# Serializes output from the threads updating each sub path.
+_PRINT_LOCK = threading.Lock()
+
+
+def _log(msg):
+  with _PRINT_LOCK:
+    print(msg)
+
+
+def _recorded_commit(sub_dir, sub):
+  """Returns the commit recorded in sub_dir's README.md, or None."""
+  prefix = f'{BASE_URL}/+/'
+  suffix = f'/{sub}'
+  try:
+    with open(os.path.join(sub_dir, 'README.md')) as rmd:
+      for line in rmd:
+        line = line.strip()
+        if line.startswith(prefix) and line.endswith(suffix):
+          return line[len(prefix):-len(suffix)]
+  except FileNotFoundError:
+    pass
+  return None
+
+
+def _wanted_members(members, dest_dir):
+  """Yields the members of a proto archive which should be extracted.
+
+  Also creates each parent directory the members will be extracted to, once
+  per directory, after checking that it is inside dest_dir.
+
+  Raises ValueError for a member which would be extracted outside of dest_dir.
+  """
+  made_dirs = set()
+  for item in members:
+    name = item.name
+    if not item.isfile() or not name.endswith('.proto'):
+      continue
+    if name.endswith('_test.proto') or 'internal' in name:
+      _log(f'Skipping {name!r}')
+      continue
+    _log(f'Extracting {name!r}')
+    parent = os.path.dirname(name)
+    if parent not in made_dirs:
+      # Member names end in '.proto', so only their directory can escape
+      # dest_dir.
+      if os.path.isabs(parent) or '..' in parent.split('/'):
+        raise ValueError(f'{name!r} is outside of {dest_dir!r}')
+      made_dirs.add(parent)
+      os.makedirs(os.path.join(dest_dir, parent), exist_ok=True)
+    yield item
+
+
+def _write_member(path, data):
+  """Writes out one extracted archive member with a single write().
+
+  Mode and mtime are not restored from the archive; the protos are plain
+  checked-in files.
+  """
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  try:
+    view = memoryview(data)
+    while view:
+      view = view[os.write(fd, view):]
+  finally:
+    os.close(fd)
+
+
+def _fetch_archive(sub, commit):
+  """Returns the bytes of the .tar.gz archive of sub at commit.
+
+  Archives are cached on disk under CACHE_DIR, keeping the CACHE_KEEP most
+  recently downloaded ones for each sub path.
+  """
+  cache_dir = os.path.join(CACHE_DIR, os.path.normpath(sub))
+  cache_path = os.path.join(cache_dir, f'{commit}.tar.gz')
+  try:
+    with open(cache_path, 'rb') as f:
+      return f.read()
+  except FileNotFoundError:
+    pass
+
+  resp = SESSION.get(f'{BASE_URL}/+archive/{commit}/{sub}.tar.gz', stream=True)
+  resp.raise_for_status()
+  # iter_content undoes any transport Content-Encoding.
+  buf = io.BytesIO()
+  for chunk in resp.iter_content(COPY_BUFSIZE):
+    buf.write(chunk)
+  data = buf.getvalue()
+
+  # Write to a temporary file first so an interrupted run never leaves a
+  # truncated archive in the cache.
+  os.makedirs(cache_dir, exist_ok=True)
+  tmp_path = cache_path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(data)
+  os.replace(tmp_path, cache_path)
+
+  cached = sorted(
+      (os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+       if name.endswith('.tar.gz')),
+      key=os.path.getmtime, reverse=True)
+  for path in cached[CACHE_KEEP:]:
+    os.remove(path)
+  return data
+
+
+def _update_one(etags, sub, sub_dir):
+  """Updates the .proto files of one of SUB_PATHS.
+
+  Args:
+    * etags (dict): Maps each sub path to the ETag and commit of its last log
+      response. Updated in place.
+    * sub (str): The sub path to update.
+    * sub_dir (str): The absolute local directory for sub.
+  """
+  # Sibling sub paths are updated concurrently and may share parent
+  # directories, so don't check-then-create.
+  os.makedirs(sub_dir, exist_ok=True)
+
+  # Make the log request conditional on the ETag of the last response seen, if
+  # any; gitiles answers 304 with no body when the log hasn't changed.
+  cached = etags.get(sub)
+  headers = {'Accept-Encoding': 'gzip'}
+  if cached:
+    headers['If-None-Match'] = cached['etag']
+  resp = SESSION.get(
+      f'{BASE_URL}/+log/master/{sub}?format=JSON&n=1', headers=headers)
+  if resp.status_code == 304:
+    commit = cached['commit']
+  else:
+    resp.raise_for_status()
+    # Parse the body bytes directly (skipping the ")]}'" XSSI prefix), rather
+    # than decoding the whole body to text first.
+    commit = json.loads(resp.content[4:])['log'][0]['commit']
+    etag = resp.headers.get('ETag')
+    if etag:
+      etags[sub] = {'etag': etag, 'commit': commit}
+  # README.md is written last, so if it records this commit the sub path is
+  # already fully up to date.
+  if _recorded_commit(sub_dir, sub) == commit:
+    _log(f'{sub!r} is up to date at {commit!r}')
+    return
+  _log(f'Updating {sub!r} to {commit!r}')
+
+  # The proto archives are small, so hold each one in memory; tarfile can then
+  # access it randomly instead of as a stream.
+  buf = io.BytesIO(_fetch_archive(sub, commit))
+
+  # Reading the archive is serial, but the files in it can be written out
+  # concurrently.
+  with ThreadPoolExecutor(MAX_WRITERS) as writer:
+    # The archive is always a .tar.gz, so don't bother detecting compression.
+    with tarfile.open(mode='r:gz', fileobj=buf) as tar:
+      writes = [
+          writer.submit(
+              _write_member, os.path.join(sub_dir, item.name),
+              tar.extractfile(item).read())
+          for item in _wanted_members(tar.getmembers(), sub_dir)
+      ]
+    for write in writes:
+      write.result()
+
+  readme = (
+      '// Generated by update.py. DO NOT EDIT.\n'
+      'These protos were copied from:\n'
+      f'{BASE_URL}/+/{commit}/{sub}\n')
+  readme_path = os.path.join(sub_dir, 'README.md')
+  try:
+    with open(readme_path) as rmd:
+      old_readme = rmd.read()
+  except FileNotFoundError:
+    old_readme = None
+  # Leave the file (and its mtime) alone if it's already right.
+  if readme != old_readme:
+    with open(readme_path, 'w') as rmd:
+      rmd.write(readme)
+
+
 def main():
   """Automatically updates the .proto files in this directory."""
   base_dir = os.path.abspath(os.path.dirname(__file__))
 
-  for sub in SUB_PATHS:
-    sub_dir = os.path.join(base_dir, os.path.normpath(sub))
-    if not os.path.exists(sub_dir):
-      os.makedirs(sub_dir)
-    os.chdir(sub_dir)
-
-    resp = requests.get(LOG_URL % (sub,))
-    commit = str(json.loads(resp.text[4:])['log'][0]['commit'])
-    print 'Updating %r to %r' % (sub, commit)
-
-    resp = requests.get(TAR_URL % (commit, sub), stream=True).raw
-    with tarfile.open(mode='r|*', fileobj=resp) as tar:
-      for item in tar:
-        if item.name.endswith('_test.proto'):
-          print 'Skipping %r' % item.name
-          continue
-        if 'internal' in item.name:
-          print 'Skipping %r' % item.name
-          continue
-        if item.name.endswith('.proto'):
-          print 'Extracting %r' % item.name
-          tar.extract(item, '.')
-
-    with open('README.md', 'w') as rmd:
-      print >> rmd, '// Generated by update.py. DO NOT EDIT.'
-      print >> rmd, 'These protos were copied from:'
-      print >> rmd, BASE_URL+'/+/'+commit+'/'+sub
-
-  print 'Done.'
+  etags_path = os.path.join(base_dir, ETAGS_FILE)
+  try:
+    with open(etags_path) as f:
+      etags = json.load(f)
+  except FileNotFoundError:
+    etags = {}
+
+  sub_dirs = [
+      os.path.join(base_dir, os.path.normpath(sub)) for sub in SUB_PATHS]
+
+  # The sub paths are independent and the work is network-bound, so update
+  # them all concurrently.
+  try:
+    with ThreadPoolExecutor(len(SUB_PATHS)) as pool:
+      for _ in pool.map(lambda args: _update_one(etags, *args),
+                        zip(SUB_PATHS, sub_dirs)):
+        pass
+  finally:
+    with open(etags_path, 'w') as f:
+      json.dump(etags, f, indent=2, sort_keys=True)
+
+  print('Done.')
 
 
 if __name__ == '__main__':
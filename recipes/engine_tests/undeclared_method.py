@@ -17,6 +17,18 @@ PROPERTIES = {
   'module': Property(kind=bool, default=False),
 }
 
+# Expected failure reasons of the tests below.
+FROM_RECIPE_REASON = (
+    "Uncaught Exception: ModuleInjectionError(\"RecipeApi has no "
+    "dependency 'missing_module'. (Add it to DEPS?)\",)")
+ATTRIBUTE_REASON = (
+    "Uncaught Exception: AttributeError(\"'PythonApi' object has no "
+    "attribute 'missing_method'\",)")
+MODULE_REASON = (
+    "Uncaught Exception: ModuleInjectionError(\"Recipe Module "
+    "'python' has no dependency 'missing_module'. (Add it to "
+    "__init__.py:DEPS?)\",)")
+
 def RunSteps(api, from_recipe, attribute, module):
   # We test on the python module because it's a RecipeApi, not a RecipeApiPlain.
   if from_recipe:
@@ -31,32 +43,19 @@ def GenTests(api):
       api.test('from_recipe') +
       api.properties(from_recipe=True) +
       api.expect_exception('ModuleInjectionError') +
-      api.post_process(
-          post_process.ResultReason,
-          "Uncaught Exception: ModuleInjectionError(\"RecipeApi has no "
-          "dependency 'missing_module'. (Add it to DEPS?)\",)",
-      ) +
+      api.post_process(post_process.ResultReason, FROM_RECIPE_REASON) +
       api.post_process(post_process.DropExpectation))
 
   yield (
       api.test('attribute') +
       api.properties(attribute=True) +
       api.expect_exception('AttributeError') +
-      api.post_process(
-          post_process.ResultReason,
-          "Uncaught Exception: AttributeError(\"'PythonApi' object has no "
-          "attribute 'missing_method'\",)",
-      ) +
+      api.post_process(post_process.ResultReason, ATTRIBUTE_REASON) +
       api.post_process(post_process.DropExpectation))
 
   yield (
       api.test('module') +
       api.properties(module=True) +
       api.expect_exception('ModuleInjectionError') +
-      api.post_process(
-          post_process.ResultReason,
-          "Uncaught Exception: ModuleInjectionError(\"Recipe Module "
-          "'python' has no dependency 'missing_module'. (Add it to "
-          "__init__.py:DEPS?)\",)",
-      ) +
+      api.post_process(post_process.ResultReason, MODULE_REASON) +
       api.post_process(post_process.DropExpectation))
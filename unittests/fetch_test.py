@@ -42,6 +42,7 @@ class TestGit(test_env.RecipeEngineUnitTest):
   def setUp(self):
     super(TestGit, self).setUp()
     fetch.Backend._GIT_METADATA_CACHE = {}
+    fetch.GitBackend._CHECKOUT_CACHE = {}
     mock.patch(fetch.__name__+'.GitBackend.GIT_BINARY', 'GIT').start()
     self.addCleanup(mock.patch.stopall)
 
@@ -151,6 +152,62 @@ class TestGit(test_env.RecipeEngineUnitTest):
       mock.call('dir/.git'),
     ])
 
+  @mock.patch('os.path.isdir')
+  @mock.patch(fetch.__name__+'.GitBackend._execute')
+  def test_existing_checkout_probed_once(self, git, isdir):
+    isdir.return_value = True
+    git.side_effect = multi(*(
+      self.g_metadata_calls() + [
+      self.g(['-C', 'dir', 'diff', '--quiet', 'a'*40]),
+      self.g(['-C', 'dir', 'fetch', 'repo', 'ref']),
+    ]))
+
+    backend = fetch.GitBackend('dir', 'repo')
+    backend.checkout('ref', 'a'*40)
+    backend.fetch('ref')
+
+    self.assertMultiDone(git)
+    isdir.assert_called_once_with('dir/.git')
+
+  @mock.patch('os.path.isdir')
+  @mock.patch(fetch.__name__+'.GitBackend._execute')
+  def test_existing_checkout_cached(self, git, isdir):
+    isdir.return_value = True
+    git.side_effect = multi(*(
+      self.g_metadata_calls() + [
+      self.g(['-C', 'dir', 'diff', '--quiet', 'a'*40]),
+    ]))
+
+    fetch.GitBackend('dir', 'repo').checkout('ref', 'a'*40)
+    # Same dir/repo/revision; only verifies the checkout.
+    git.side_effect = multi(
+      self.g(['-C', 'dir', 'rev-parse', 'HEAD'], 'a'*40 + '\n'),
+      self.g(['-C', 'dir', 'diff', '--quiet', 'a'*40]),
+    )
+    fetch.GitBackend('dir', 'repo').checkout('ref', 'a'*40)
+
+    self.assertMultiDone(git)
+
+  @mock.patch('os.path.isdir')
+  @mock.patch(fetch.__name__+'.GitBackend._execute')
+  def test_existing_checkout_cached_but_modified(self, git, isdir):
+    isdir.return_value = True
+    git.side_effect = multi(*(
+      self.g_metadata_calls() + [
+      self.g(['-C', 'dir', 'diff', '--quiet', 'a'*40]),
+    ]))
+    fetch.GitBackend('dir', 'repo').checkout('ref', 'a'*40)
+
+    # Someone else moved the checkout to another revision.
+    git.side_effect = multi(
+      self.g(['-C', 'dir', 'rev-parse', 'HEAD'], 'b'*40 + '\n'),
+      self.g(['-C', 'dir', 'diff', '--quiet', 'a'*40], CPE('', 1)),
+      self.g(['-C', 'dir', 'reset', '-q', '--hard', 'a'*40]),
+    )
+    fetch.GitBackend('dir', 'repo').checkout('ref', 'a'*40)
+
+    self.assertMultiDone(git)
+
   @mock.patch('os.path.isdir')
   @mock.patch(fetch.__name__+'.GitBackend._execute')
   def test_unclean_filesystem(self, git, isdir):
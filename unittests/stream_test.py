@@ -4,10 +4,14 @@
 # that can be found in the LICENSE file.
 
 import cStringIO
+import os
+
+import mock
 
 import test_env
 
 from recipe_engine.internal.stream.annotator import AnnotatorStreamEngine
+from recipe_engine.internal.stream.invariants import INVARIANTS_ENV_VAR
 from recipe_engine.internal.stream.invariants import StreamEngineInvariants
 
 
@@ -100,6 +104,27 @@ bar tries to kiss foo, but foo already left
       self._example(engine)
     self.assertEqual(stringio.getvalue(), self._example_annotations())
 
+  def test_product_write_lines_generator(self):
+    stringio = cStringIO.StringIO()
+    engine = StreamEngineInvariants.wrap(AnnotatorStreamEngine(stringio))
+    with engine:
+      foo = engine.new_step_stream(('foo',), False)
+      foo.write_lines(line for line in ['one thing', 'and another!'])
+      foo.close()
+    self.assertIn('one thing\nand another!\n', stringio.getvalue())
+
+  def test_wrap_without_invariants(self):
+    stringio = cStringIO.StringIO()
+    annotator = AnnotatorStreamEngine(stringio)
+    self.assertIs(
+        StreamEngineInvariants.wrap(annotator, invariants=False), annotator)
+
+  def test_wrap_with_invariants_disabled_by_env(self):
+    stringio = cStringIO.StringIO()
+    annotator = AnnotatorStreamEngine(stringio)
+    with mock.patch.dict(os.environ, {INVARIANTS_ENV_VAR: '0'}):
+      self.assertIs(StreamEngineInvariants.wrap(annotator), annotator)
+
   def test_write_after_close(self):
     with StreamEngineInvariants() as engine:
       foo = engine.new_step_stream(('foo',), False)
@@ -120,6 +145,13 @@ bar tries to kiss foo, but foo already left
       with self.assertRaises(AssertionError):
         foo.write_line('one thing\nand another!')
 
+  def test_no_write_lines_with_newlines(self):
+    with StreamEngineInvariants() as engine:
+      foo = engine.new_step_stream(('foo',), False)
+      foo.write_lines(['one thing', 'and another!'])
+      with self.assertRaises(AssertionError):
+        foo.write_lines(['one thing\nand another!'])
+
   def test_invalid_status(self):
     with StreamEngineInvariants() as engine:
       foo = engine.new_step_stream(('foo',), False)